@@ -1,8 +1,9 @@
-from typing import Tuple, Optional
+from typing import Any, Dict, Tuple, Optional
 
 import cvxpy as cp
+from cvxpylayers.torch import CvxpyLayer
+from diffcp import SolverError
 import torch
-import numpy as np
 
 from neural_clbf.systems import ObservableSystem, PlanarLidarSystem  # noqa
 from neural_clbf.controllers.controller import Controller
@@ -20,6 +21,8 @@ class ObsMPCController(Controller):
         controller_period: float,
         experiment_suite: ExperimentSuite,
         validation_dynamics_model: Optional[ObservableSystem] = None,
+        analytic_ellipsoid: bool = False,
+        n_jobs: int = -1,
     ):
         """Initialize the controller.
 
@@ -29,6 +32,12 @@ class ObsMPCController(Controller):
             experiment_suite: defines the experiments to run during training
             validation_dynamics_model: optionally provide a dynamics model to use during
                                        validation
+            analytic_ellipsoid: if True, restrict the free-space ellipsoid to a circle
+                                and find the target point in closed form instead of
+                                solving the ellipsoid SDP and target QP. Much faster,
+                                but a more conservative approximation of free space.
+            n_jobs: the number of threads used to solve the problems for a batch in
+                    parallel. Defaults to -1, which uses one thread per CPU.
         """
         super(ObsMPCController, self).__init__(
             dynamics_model=dynamics_model,
@@ -45,6 +54,73 @@ class ObsMPCController(Controller):
         # Save the experiments suits
         self.experiment_suite = experiment_suite
 
+        # Save whether to use the closed-form solution
+        self.analytic_ellipsoid = analytic_ellipsoid
+
+        # The layers hand each batch to diffcp, which solves the problems for the
+        # different samples in parallel on a thread pool. The ellipsoid fit is an SDP,
+        # so it needs SCS, but the target point problem is a small SOCP that ECOS
+        # solves both faster and more accurately
+        n_jobs_args = {"n_jobs_forward": n_jobs, "n_jobs_backward": n_jobs}
+        self.ellipsoid_solver_args = {"solve_method": "SCS", **n_jobs_args}
+        self.target_solver_args = {"solve_method": "ECOS", **n_jobs_args}
+
+        # Cache the control limits, since the dynamics model builds new tensors each
+        # time they are accessed
+        self.u_upper, self.u_lower = self.dynamics_model.control_limits
+
+        # Both optimization problems are set up once here as parametric CVXPyLayers so
+        # that each call to u() solves the whole batch without re-canonicalizing.
+        #
+        # First, we compute an ellipsoid under-approximating the free space.
+        # Parameterize the ellipsoid as the 1-sublevel set of x^T P x. Symmetry is
+        # imposed as a constraint (rather than with symmetric=True) so that the layer
+        # always returns the full 2 x 2 matrix.
+        n_obs = self.dynamics_model.n_obs
+        P = cp.Variable((2, 2))
+
+        # For each detected point o_i, we want o_i^T P o_i >= 1.25. To keep the problem
+        # DPP, this is expressed in terms of the entries of the outer product o_i o_i^T,
+        # which are passed in as the rows [o_x^2, o_x o_y, o_y^2] of lidar_outer_param
+        lidar_outer_param = cp.Parameter((n_obs, 3))
+        lidar_quad_forms = (
+            lidar_outer_param[:, 0] * P[0, 0]
+            + 2 * lidar_outer_param[:, 1] * P[0, 1]
+            + lidar_outer_param[:, 2] * P[1, 1]
+        )
+
+        # The operator >> denotes matrix inequality. We want P to be PSD
+        constraints = [P == P.T, P >> 0, lidar_quad_forms >= 1.25]
+
+        # Solve for the P with largest volume
+        ellipsoid_problem = cp.Problem(
+            cp.Maximize(cp.log_det(P) - 100 * cp.trace(P)), constraints
+        )
+        assert ellipsoid_problem.is_dpp()
+        self.ellipsoid_layer = CvxpyLayer(
+            ellipsoid_problem, variables=[P], parameters=[lidar_outer_param]
+        )
+
+        # Next, we solve for a target point inside that ellipsoid minimizing
+        # ||offset + A x_target||^2. Steering towards the origin uses offset = x and
+        # A = the rotation from the local to the global frame, while steering along
+        # the major axis uses offset = -major_axis and A = I. The ellipsoid
+        # constraint x_target^T P x_target <= 0.75 is expressed using a square root
+        # of P (i.e. P = P_sqrt^T P_sqrt) to keep the problem DPP.
+        x_target = cp.Variable(2)
+        offset_param = cp.Parameter(2)
+        A_param = cp.Parameter((2, 2))
+        P_sqrt_param = cp.Parameter((2, 2))
+        objective = cp.sum_squares(offset_param + A_param @ x_target)
+        constraints = [cp.sum_squares(P_sqrt_param @ x_target) <= 0.75]
+        target_problem = cp.Problem(cp.Minimize(objective), constraints)
+        assert target_problem.is_dpp()
+        self.target_layer = CvxpyLayer(
+            target_problem,
+            variables=[x_target],
+            parameters=[offset_param, A_param, P_sqrt_param],
+        )
+
     def get_observations(self, x: torch.Tensor) -> torch.Tensor:
         """Wrapper around the dynamics model to get the observations"""
         assert isinstance(self.dynamics_model, ObservableSystem)
@@ -57,127 +133,231 @@ class ObsMPCController(Controller):
         assert isinstance(self.dynamics_model, ObservableSystem)
         return self.dynamics_model.approximate_lookahead(x, o, u, dt)
 
-    def u(self, x: torch.Tensor) -> torch.Tensor:
-        """Returns the control input at a given state. Computes the observations and
-        barrier function value at this state before computing the control.
+    def _solve_layer(
+        self,
+        layer: CvxpyLayer,
+        params: Tuple[torch.Tensor, ...],
+        solver_args: Dict[str, Any],
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Solve a CVXPyLayer for a batch of parameters. If the solver fails on any
+        problem in the batch (e.g. because it is numerically infeasible), fall back to
+        solving each problem separately, so that one failure doesn't lose the solutions
+        for the whole batch.
 
         args:
-            x: bs x self.dynamics_model.n_dims tensor of state
+            layer: the layer to solve, which must have a single output variable
+            params: the batched parameters for the layer
+            solver_args: the arguments to pass to the solver
+        returns:
+            a tuple of the batched solutions (zero where the solver failed) and a bs
+            boolean tensor indicating which problems were solved
         """
-        # Get the observations
-        obs = self.get_observations(x)
-
-        # Solve the MPC problem for each element of the batch
-        batch_size = x.shape[0]
-        u = torch.zeros(batch_size, self.dynamics_model.n_controls).type_as(x)
+        batch_size = params[0].shape[0]
+        try:
+            (solution,) = layer(*params, solver_args=solver_args)
+            return solution, torch.ones(batch_size, dtype=torch.bool)
+        except SolverError:
+            pass
+
+        variable_shape = layer.variables[0].shape
+        solution = torch.zeros(batch_size, *variable_shape).type_as(params[0])
+        solved = torch.zeros(batch_size, dtype=torch.bool)
         for batch_idx in range(batch_size):
-            batch_obs = obs[batch_idx, :, :]
-            batch_x = x[batch_idx, :2].cpu().detach().numpy()
+            batch_params = [param[batch_idx] for param in params]
+            try:
+                (batch_solution,) = layer(*batch_params, solver_args=solver_args)
+            except SolverError:
+                continue
 
-            # Compute an ellipsoid under-approximating the free space.
-            # Parameterize the ellipsoid as the 1-sublevel set of x^T P x
-            P = cp.Variable((2, 2), symmetric=True)
+            solution[batch_idx] = batch_solution
+            solved[batch_idx] = True
 
-            # The operator >> denotes matrix inequality. We want P to be PSD
-            constraints = [P >> 0]
+        return solution, solved
 
-            # For each detected point, we want x^T P x >= 1.1
-            for point_idx in range(batch_obs.shape[-1]):
-                o_i = batch_obs[:, point_idx].reshape(-1, 1).cpu().detach().numpy()
-                constraints.append(cp.quad_form(o_i, P) >= 1.25)
+    def _target_points_cvxpylayers(
+        self, obs: torch.Tensor, x: torch.Tensor
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Find the target point for each state by fitting the largest-volume ellipsoid
+        to the lidar points and finding the point in that ellipsoid closest to the
+        origin (or along the major axis of the ellipsoid, if we are stuck). Solves both
+        problems using CVXPyLayers.
 
-            # Solve for the P with largest volume
-            prob = cp.Problem(
-                cp.Maximize(cp.log_det(P) - 100 * cp.trace(P)), constraints
-            )
-            prob.solve()
-            # Skip if no solution
-            if prob.status != "optimal":
-                continue
+        args:
+            obs: bs x self.dynamics_model.obs_dim x self.dynamics_model.n_obs tensor of
+                 observations, none of which may be zero
+            x: bs x self.dynamics_model.n_dims tensor of state
+        returns:
+            a tuple of a bs x 2 tensor of target points in the global frame and a bs
+            boolean tensor indicating which samples a target point was found for
+        """
+        # Fit the ellipsoids to the lidar points
+        lidar_pts = obs.transpose(1, 2)
+        lidar_outer = torch.stack(
+            (
+                lidar_pts[:, :, 0] ** 2,
+                lidar_pts[:, :, 0] * lidar_pts[:, :, 1],
+                lidar_pts[:, :, 1] ** 2,
+            ),
+            dim=-1,
+        )
+        P_opt, solved = self._solve_layer(
+            self.ellipsoid_layer, (lidar_outer,), self.ellipsoid_solver_args
+        )
 
-            # Otherwise, continue on
-            P_opt = P.value
+        # Get the principal axes of each ellipsoid, which also give us a square root
+        # of P for the target point constraint
+        P_eigenvals, P_eigenvectors = torch.linalg.eigh(P_opt)
+        P_sqrt = torch.diag_embed(P_eigenvals.clamp(min=0.0).sqrt())
+        P_sqrt = torch.bmm(P_sqrt, P_eigenvectors.transpose(1, 2))
+
+        # x_target and P are in the local frame, so we need a rotation to
+        # compare with the global origin
+        theta = x[:, 2]
+        c, s = torch.cos(theta), torch.sin(theta)
+        rotation_mat = torch.stack((c, -s, s, c), dim=-1).reshape(-1, 2, 2)
+
+        # Solve for the point inside each ellipsoid closest to the origin (for those
+        # samples where we found an ellipsoid)
+        x_target_opt = torch.zeros_like(x[:, :2])
+        if solved.any():
+            x_target_opt[solved], target_solved = self._solve_layer(
+                self.target_layer,
+                (x[solved, :2], rotation_mat[solved], P_sqrt[solved]),
+                self.target_solver_args,
+            )
+            solved[solved.clone()] = target_solved
+
+        # If we are not at the goal and stuck by a wall, then steer towards the
+        # furthest point in the safe ellipse
+        minor_axis_length = 1 / P_eigenvals[:, -1]
+        stuck = minor_axis_length < 0.1
+        at_goal = x[:, :2].norm(dim=-1) < 1e-1
+        steer_to_major_axis = torch.logical_and(stuck, torch.logical_not(at_goal))
+        steer_to_major_axis = torch.logical_and(steer_to_major_axis, solved)
+        if steer_to_major_axis.any():
+            major_axis = P_eigenvectors[steer_to_major_axis, :, 0]
+
+            # Pick a direction for the major axis arbitrarily (so that we don't turn
+            # around unnecessarily).
+            major_axis[major_axis[:, 0] < 0] *= -1
+
+            # Re-solve the problem steering towards this point. If that fails, keep
+            # steering towards the point closest to the origin
+            identity = torch.eye(2).type_as(x).expand(major_axis.shape[0], 2, 2)
+            x_target_major_axis, major_axis_solved = self._solve_layer(
+                self.target_layer,
+                (-major_axis, identity, P_sqrt[steer_to_major_axis]),
+                self.target_solver_args,
+            )
+            steer_to_major_axis[steer_to_major_axis.clone()] = major_axis_solved
+            x_target_opt[steer_to_major_axis] = x_target_major_axis[major_axis_solved]
 
-            # Next, solve for the point inside that ellipsoid closest to the origin
-            x_target = cp.Variable(2)
+        # Convert to the global frame
+        x_target_opt = torch.bmm(rotation_mat, x_target_opt.unsqueeze(-1)).squeeze(-1)
 
-            # x_target and P are in the local frame, so we need a rotation to
-            # compare with the global origin
-            theta = x[batch_idx, 2].cpu().detach().numpy()
-            rotation_mat = np.array(
-                [
-                    [np.cos(theta), -np.sin(theta)],
-                    [np.sin(theta), np.cos(theta)],
-                ]
-            )
+        return x_target_opt, solved
 
-            objective = cp.sum_squares(batch_x + rotation_mat @ x_target)
+    def _circle_fit(self, obs: torch.Tensor) -> torch.Tensor:
+        """Fit the largest-volume circle P = alpha * I to the lidar points, i.e. solve
+        the ellipsoid problem from _target_points_cvxpylayers restricted to circles.
 
-            # We also want x_target to be within the ellipsoid
-            constraints.append(cp.quad_form(x_target, P_opt) <= 0.75)
+        args:
+            obs: bs x self.dynamics_model.obs_dim x self.dynamics_model.n_obs tensor of
+                 observations, none of which may be zero
+        returns:
+            bs tensor of alpha
+        """
+        # Maximizing log_det(P) - 100 trace(P) = 2 log(alpha) - 200 alpha subject to
+        # alpha ||o_i||^2 >= 1.25 picks the smallest alpha allowed by the closest
+        # point, unless that is below the unconstrained optimum alpha = 0.01
+        alpha = 1.25 / (obs ** 2).sum(dim=1).min(dim=-1).values
+        return alpha.clamp(min=0.01)
+
+    def _target_points_analytic(
+        self, obs: torch.Tensor, x: torch.Tensor
+    ) -> torch.Tensor:
+        """Find the target point for each state as in _target_points_cvxpylayers, but
+        restrict the ellipsoid to a circle P = alpha * I, so that both problems have
+        closed-form solutions.
 
-            # Solve for the target point
-            prob = cp.Problem(cp.Minimize(objective), constraints)
-            prob.solve()
-            x_target_opt = x_target.value
+        args:
+            obs: bs x self.dynamics_model.obs_dim x self.dynamics_model.n_obs tensor of
+                 observations, none of which may be zero
+            x: bs x self.dynamics_model.n_dims tensor of state
+        returns:
+            bs x 2 tensor of target points in the global frame
+        """
+        alpha = self._circle_fit(obs)
+
+        # The target point constraint x_target^T P x_target <= 0.75 is then a disk, and
+        # since rotations preserve distances, the point in that disk closest to the
+        # origin is just the projection of -x onto the disk
+        radius = (0.75 / alpha).sqrt()
+        distance_to_origin = x[:, :2].norm(dim=-1)
+        scale = (radius / distance_to_origin).clamp(max=1.0)
+        x_target_opt = -x[:, :2] * scale.unsqueeze(-1)
+
+        # If we are not at the goal and stuck by a wall, then steer along the major
+        # axis. Every axis of a circle is a major axis, so (matching eigh on alpha * I)
+        # use the local x axis, i.e. the robot's heading in the global frame
+        minor_axis_length = 1 / alpha
+        stuck = minor_axis_length < 0.1
+        at_goal = distance_to_origin < 1e-1
+        steer_to_major_axis = torch.logical_and(stuck, torch.logical_not(at_goal))
+        theta = x[:, 2]
+        heading = torch.stack((torch.cos(theta), torch.sin(theta)), dim=-1)
+        major_axis_target = heading * radius.clamp(max=1.0).unsqueeze(-1)
+        x_target_opt[steer_to_major_axis] = major_axis_target[steer_to_major_axis]
+
+        return x_target_opt
 
-            # Skip if no solution
-            if prob.status != "optimal":
-                continue
+    def u(self, x: torch.Tensor) -> torch.Tensor:
+        """Returns the control input at a given state. Computes the observations and
+        barrier function value at this state before computing the control.
 
-            # and convert to the global frame
-            x_target_opt = rotation_mat @ x_target_opt
-
-            # Now navigate towards that point by offsetting x from this target point
-            # (shifting the origin) and applying the nominal controller
-            x_shifted = torch.tensor(-x_target_opt).type_as(x)
-            x_shifted = torch.cat((x_shifted, x[batch_idx, 2].unsqueeze(-1)))
-            u[batch_idx, :] = self.dynamics_model.u_nominal(
-                x_shifted.reshape(1, -1), track_zero_angle=False  # type: ignore
-            ).squeeze()
-
-            # If we are not at the goal and stuck by a wall, then steer towards the
-            # furthest point in the safe ellipse
-            P_eigenvals, P_eigenvectors = np.linalg.eigh(P_opt)
-            minor_axis_length = 1 / P_eigenvals[-1]
-            stuck = minor_axis_length < 0.1
-            at_goal = np.linalg.norm(batch_x) < 1e-1
-            if not at_goal and stuck:
-                major_axis = P_eigenvectors[:, 0]
-
-                # Pick a direction for the major axis arbitrarily (so that we don't turn
-                # around unnecessarily).
-                if major_axis[0] < 0:
-                    major_axis *= -1
-
-                # Re-solve the problem steering towards this point
-                objective = cp.sum_squares(x_target - major_axis)
-                prob = cp.Problem(cp.Minimize(objective), constraints)
-                prob.solve()
-                x_target_opt = x_target.value
-
-                # Skip if no solution
-                if prob.status != "optimal":
-                    continue
-
-                # and convert to the global frame
-                x_target_opt = rotation_mat @ x_target_opt
-
-                # Now navigate towards that point by offsetting x from this target point
-                # (shifting the origin) and applying the nominal controller
-                x_shifted = torch.tensor(-x_target_opt).type_as(x)
-                x_shifted = torch.cat((x_shifted, x[batch_idx, 2].unsqueeze(-1)))
-                u[batch_idx, :] = self.dynamics_model.u_nominal(
-                    x_shifted.reshape(1, -1), track_zero_angle=False  # type: ignore
-                ).squeeze()
+        args:
+            x: bs x self.dynamics_model.n_dims tensor of state
+        """
+        # Get the observations. The lidar model and the solvers both work on the CPU,
+        # so move everything there once and only move the controls back to the device
+        # of x at the end
+        x_cpu = x.detach().cpu()
+        obs = self.get_observations(x_cpu).detach()
+
+        # Solve the MPC problem for the whole batch at once. The ellipsoid fit is only
+        # feasible if none of the lidar points coincide with the robot (otherwise no
+        # ellipse can exclude that point), so samples where that happens get zero
+        # control, as do any samples where the solver fails.
+        batch_size = x_cpu.shape[0]
+        u = torch.zeros(batch_size, self.dynamics_model.n_controls).type_as(x_cpu)
+        solvable = ((obs ** 2).sum(dim=1) > 1e-8).all(dim=-1)
+        if solvable.any():
+            obs_solvable, x_solvable = obs[solvable], x_cpu[solvable]
+            if self.analytic_ellipsoid:
+                x_target = self._target_points_analytic(obs_solvable, x_solvable)
+            else:
+                x_target, solved = self._target_points_cvxpylayers(
+                    obs_solvable, x_solvable
+                )
+                x_target, x_solvable = x_target[solved], x_solvable[solved]
+                solvable[solvable.clone()] = solved
+
+            # Now navigate towards the target point by offsetting x from it (shifting
+            # the origin) and applying the nominal controller
+            x_shifted = torch.cat((-x_target, x_solvable[:, 2].unsqueeze(-1)), dim=-1)
+            u[solvable] = self.dynamics_model.u_nominal(
+                x_shifted, track_zero_angle=False  # type: ignore
+            ).type_as(u)
 
         # Scale the velocities a bit
         u[:, 0] *= 2.0
-        u_upper, u_lower = self.dynamics_model.control_limits
-        u = torch.clamp(u, u_lower, u_upper)
+        if self.u_upper.dtype != u.dtype or self.u_upper.device != u.device:
+            self.u_upper = self.u_upper.type_as(u)
+            self.u_lower = self.u_lower.type_as(u)
+        u = torch.clamp(u, self.u_lower, self.u_upper)
 
         # Stop if goal reached
-        goal_reached = x[:, :2].norm(dim=-1) < 0.75
+        goal_reached = x_cpu[:, :2].norm(dim=-1) < 0.75
         u[goal_reached] *= 0.0
 
-        return u
+        return u.type_as(x)
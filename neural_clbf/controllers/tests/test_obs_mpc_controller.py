@@ -0,0 +1,198 @@
+"""Test the MPC controller for perception-based control"""
+import cvxpy as cp
+import numpy as np
+import pytest
+from shapely.geometry import box
+import torch
+
+from neural_clbf.controllers.obs_mpc_controller import ObsMPCController
+from neural_clbf.experiments import ExperimentSuite
+from neural_clbf.systems import TurtleBot2D
+from neural_clbf.systems.planar_lidar_system import Scene
+
+
+@pytest.fixture
+def controller():
+    """Make an MPC controller for a turtlebot in a walled room with one box"""
+    scene = Scene([])
+    scene.add_walls(10.0)
+    scene.add_obstacle(box(-3.0, -3.0, -2.0, -2.0))
+
+    dynamics_model = TurtleBot2D(
+        {"R": 3.25, "L": 14.0},
+        scene,
+        dt=0.01,
+        controller_dt=0.1,
+        num_rays=32,
+        field_of_view=(-np.pi / 4, np.pi / 4),
+        max_distance=2.0,
+    )
+
+    return ObsMPCController(dynamics_model, 0.1, ExperimentSuite([]))
+
+
+def reference_u(controller: ObsMPCController, x: torch.Tensor) -> torch.Tensor:
+    """Compute the MPC control by solving the problems for each sample separately
+    with CVXPY, without any of the reformulations used by the controller.
+    """
+    obs = controller.get_observations(x)
+
+    u = torch.zeros(x.shape[0], controller.dynamics_model.n_controls)
+    for batch_idx in range(x.shape[0]):
+        batch_obs = obs[batch_idx].numpy()
+        batch_x = x[batch_idx, :2].numpy()
+
+        # Fit the largest-volume ellipsoid to the lidar points
+        P = cp.Variable((2, 2), symmetric=True)
+        constraints = [P >> 0]
+        for point_idx in range(batch_obs.shape[-1]):
+            o_i = batch_obs[:, point_idx].reshape(-1, 1)
+            constraints.append(cp.quad_form(o_i, P) >= 1.25)
+        prob = cp.Problem(cp.Maximize(cp.log_det(P) - 100 * cp.trace(P)), constraints)
+        prob.solve()
+        if prob.status != "optimal":
+            continue
+        P_opt = P.value
+
+        # Find the point in that ellipsoid closest to the origin
+        x_target = cp.Variable(2)
+        theta = x[batch_idx, 2].item()
+        rotation_mat = np.array(
+            [
+                [np.cos(theta), -np.sin(theta)],
+                [np.sin(theta), np.cos(theta)],
+            ]
+        )
+        objective = cp.sum_squares(batch_x + rotation_mat @ x_target)
+        target_constraints = [cp.quad_form(x_target, P_opt) <= 0.75]
+
+        # If we are not at the goal and stuck by a wall, then steer along the major
+        # axis instead
+        P_eigenvals, P_eigenvectors = np.linalg.eigh(P_opt)
+        stuck = 1 / P_eigenvals[-1] < 0.1
+        at_goal = np.linalg.norm(batch_x) < 1e-1
+        if stuck and not at_goal:
+            major_axis = P_eigenvectors[:, 0]
+            if major_axis[0] < 0:
+                major_axis *= -1
+            objective = cp.sum_squares(x_target - major_axis)
+
+        prob = cp.Problem(cp.Minimize(objective), target_constraints)
+        prob.solve()
+        if prob.status != "optimal":
+            continue
+
+        # Navigate towards the target point (in the global frame)
+        x_target_opt = torch.tensor(rotation_mat @ x_target.value).type_as(x)
+        x_shifted = torch.cat((-x_target_opt, x[batch_idx, 2].unsqueeze(-1)))
+        u[batch_idx, :] = controller.dynamics_model.u_nominal(
+            x_shifted.reshape(1, -1), track_zero_angle=False  # type: ignore
+        ).squeeze()
+
+    # Scale, clamp, and stop at the goal
+    u[:, 0] *= 2.0
+    u_upper, u_lower = controller.dynamics_model.control_limits
+    u = torch.clamp(u, u_lower, u_upper)
+    u[x[:, :2].norm(dim=-1) < 0.75] *= 0.0
+
+    return u
+
+
+def test_obs_mpc_controller_u(controller):
+    """Test the control for a batch mixing different kinds of states"""
+    x = torch.tensor(
+        [
+            [2.0, 2.0, 0.5],  # free
+            [-1.0, 3.0, -2.0],  # free
+            [4.9, 0.0, 0.0],  # facing a wall (and stuck)
+            [-2.5, -2.5, 0.0],  # in collision
+            [5.0 - 1e-4, 0.0, 0.0],  # touching a wall (the fit is infeasible)
+            [0.05, 0.0, 0.0],  # at the goal
+        ]
+    )
+    u = controller.u(x)
+
+    # Check the shape and type of the control
+    assert u.shape == (x.shape[0], controller.dynamics_model.n_controls)
+    assert u.dtype == x.dtype
+    assert torch.isfinite(u).all()
+
+    # Check that the control limits are respected
+    u_upper, u_lower = controller.dynamics_model.control_limits
+    assert (u <= u_upper).all()
+    assert (u >= u_lower).all()
+
+    # We should move when free, and stop when in collision, touching a wall, or at
+    # the goal
+    assert u[:2].abs().sum(dim=-1).gt(0.0).all()
+    assert torch.allclose(u[3:], torch.zeros_like(u[3:]))
+
+
+def test_obs_mpc_controller_solver_failure(controller):
+    """Test that a sample the solver fails on doesn't affect the rest of the batch"""
+    x_free = torch.tensor([[2.0, 2.0, 0.5]])
+    x_touching_wall = torch.tensor([[5.0 - 1e-4, 0.0, 0.0]])
+
+    # The solver fails when touching a wall, so we should get zero control
+    u = controller.u(x_touching_wall)
+    assert torch.allclose(u, torch.zeros_like(u))
+
+    # and the other samples should get the same control as if solved alone
+    u = controller.u(torch.cat((x_free, x_touching_wall)))
+    assert torch.allclose(u[0], controller.u(x_free)[0], atol=1e-3)
+    assert torch.allclose(u[1], torch.zeros_like(u[1]))
+
+
+def test_obs_mpc_controller_matches_reference(controller):
+    """Test the batched control against solving each sample with CVXPY"""
+    x = torch.tensor(
+        [
+            [2.0, 2.0, 0.5],
+            [-1.0, 3.0, -2.0],
+            [3.0, -1.0, 2.5],
+            [4.9, 0.0, 0.0],
+        ]
+    )
+    u = controller.u(x)
+    u_expected = reference_u(controller, x)
+    assert torch.allclose(u, u_expected, atol=5e-2)
+
+
+def test_obs_mpc_controller_analytic_targets(controller):
+    """Test the closed-form target points for a circular free-space fit"""
+    # Make some observations with the closest point at different distances: far
+    # away (so the fit is limited by the trace penalty), nearby, and very close
+    # (so the robot is stuck)
+    n_obs = controller.dynamics_model.n_obs
+    angles = torch.linspace(-np.pi / 4, np.pi / 4, n_obs)
+    directions = torch.stack((torch.cos(angles), torch.sin(angles)))
+    distances = torch.tensor([20.0, 0.5, 0.05])
+    obs = directions.unsqueeze(0) * distances.reshape(-1, 1, 1)
+    # Move some of the points further away; only the closest point should matter
+    obs[:, :, : n_obs // 2] *= 3.0
+
+    # The fit should be the smallest alpha allowed by the closest point, but no
+    # smaller than the unconstrained optimum
+    alpha = controller._circle_fit(obs)
+    expected_alpha = torch.tensor([0.01, 1.25 / 0.5 ** 2, 1.25 / 0.05 ** 2])
+    assert torch.allclose(alpha, expected_alpha)
+
+    # Make the target points for a state far from the goal
+    x = torch.tensor([3.0, 4.0, 0.3]).expand(obs.shape[0], 3)
+    x_target = controller._target_points_analytic(obs, x)
+    assert x_target.shape == (obs.shape[0], 2)
+
+    # All targets should be inside the circle
+    assert ((x_target ** 2).sum(dim=-1) * alpha <= 0.75 + 1e-5).all()
+
+    # When not stuck, the target should be the closest point in the circle to the
+    # origin. The largest circle contains the origin, so that is the target, while
+    # the smaller one gives the point towards the origin at the circle's radius
+    radius = (0.75 / alpha).sqrt()
+    assert torch.allclose(x_target[0], -x[0, :2])
+    towards_origin = -x[1, :2] / x[1, :2].norm()
+    assert torch.allclose(x_target[1], towards_origin * radius[1])
+
+    # When stuck, the target should be along the heading of the robot
+    heading = torch.tensor([np.cos(0.3), np.sin(0.3)]).type_as(x)
+    assert torch.allclose(x_target[2], heading * radius[2].clamp(max=1.0))
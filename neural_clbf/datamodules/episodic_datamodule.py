@@ -4,6 +4,8 @@ sampling from fixed sets.
 Code based on the Pytorch Lightning example at
 pl_examples/domain_templates/reinforce_learn_Qnet.py
 """
+import hashlib
+import os
 from typing import List, Callable, Tuple, Dict, Optional
 
 import torch
@@ -11,7 +13,7 @@ import pytorch_lightning as pl
 from torch.utils.data import TensorDataset, DataLoader
 
 
-from neural_clbf.systems import ControlAffineSystem
+from neural_clbf.systems import ControlAffineSystem, PlanarLidarSystem
 
 
 class EpisodicDataModule(pl.LightningDataModule):
@@ -19,6 +21,9 @@ class EpisodicDataModule(pl.LightningDataModule):
     DataModule for sampling from a replay buffer
     """
 
+    # Number of points to evaluate the goal/safe/unsafe masks on at a time
+    MASK_CHUNK_SIZE = 262144
+
     def __init__(
         self,
         model: ControlAffineSystem,
@@ -30,6 +35,7 @@ class EpisodicDataModule(pl.LightningDataModule):
         val_split: float = 0.1,
         batch_size: int = 64,
         quotas: Optional[Dict[str, float]] = None,
+        cache_dir: Optional[str] = None,
     ):
         """Initialize the DataModule
 
@@ -46,6 +52,10 @@ class EpisodicDataModule(pl.LightningDataModule):
                     fixed samples that should be taken from the safe,
                     unsafe, boundary, and goal sets. Expects keys to be either "safe",
                     "unsafe", "boundary", or "goal".
+            cache_dir: if provided, save the initial dataset generated by
+                       prepare_data to this directory, and load it from there on
+                       later runs with the same settings and random seed instead of
+                       generating it again.
         """
         super().__init__()
 
@@ -63,10 +73,16 @@ class EpisodicDataModule(pl.LightningDataModule):
             self.quotas = quotas
         else:
             self.quotas = {}
+        self.cache_dir = cache_dir
 
         # Define the sampling intervals for initial conditions as a hyper-rectangle
         assert len(initial_domain) == self.n_dims
         self.initial_domain = initial_domain
+        # and save the offset and range of that hyper-rectangle for scaling samples
+        domain_min = torch.tensor([min_val for min_val, _ in initial_domain])
+        domain_max = torch.tensor([max_val for _, max_val in initial_domain])
+        self.initial_domain_min = domain_min
+        self.initial_domain_range = domain_max - domain_min
 
         # Save the min, max, central point, and range tensors
         self.x_max, self.x_min = model.state_limits
@@ -84,12 +100,11 @@ class EpisodicDataModule(pl.LightningDataModule):
                        the specified number of timesteps
         """
         # Start by sampling from initial conditions from the given region
+        # (scaling the samples in place, so no temporaries are needed)
         x_init = torch.Tensor(self.trajectories_per_episode, self.n_dims).uniform_(
             0.0, 1.0
         )
-        for i in range(self.n_dims):
-            min_val, max_val = self.initial_domain[i]
-            x_init[:, i] = x_init[:, i] * (max_val - min_val) + min_val
+        x_init.mul_(self.initial_domain_range).add_(self.initial_domain_min)
 
         # Simulate each initial condition out for the specified number of steps
         x_sim = simulator(x_init, self.trajectory_length)
@@ -104,72 +119,232 @@ class EpisodicDataModule(pl.LightningDataModule):
         """
         Generate new data points by sampling uniformly from the state space
         """
-        samples = []
+        # Fill the samples into a single preallocated tensor (rather than stacking a
+        # list of tensors at the end), so each region's samples can be freed as soon
+        # as they are copied in
+        samples = torch.empty(self.fixed_samples, self.n_dims)
+
         # Figure out how many points are to be sampled at random, how many from the
         # goal, safe, or unsafe regions specifically
         allocated_samples = 0
+        filled_samples = 0
         for region_name, quota in self.quotas.items():
             num_samples = int(self.fixed_samples * quota)
             allocated_samples += num_samples
 
             if region_name == "goal":
-                samples.append(self.model.sample_goal(num_samples))
+                sampler = self.model.sample_goal
             elif region_name == "safe":
-                samples.append(self.model.sample_safe(num_samples))
+                sampler = self.model.sample_safe
             elif region_name == "unsafe":
-                samples.append(self.model.sample_unsafe(num_samples))
+                sampler = self.model.sample_unsafe
             elif region_name == "boundary":
-                samples.append(self.model.sample_boundary(num_samples))
+                sampler = self.model.sample_boundary
+            else:
+                continue
+
+            samples[filled_samples : filled_samples + num_samples] = sampler(
+                num_samples
+            )
+            filled_samples += num_samples
 
         # Sample all remaining points uniformly at random
         free_samples = self.fixed_samples - allocated_samples
         assert free_samples >= 0
-        samples.append(self.model.sample_state_space(free_samples))
+        samples[filled_samples : filled_samples + free_samples] = (
+            self.model.sample_state_space(free_samples)
+        )
+        filled_samples += free_samples
 
-        return torch.vstack(samples)
+        return samples[:filled_samples]
 
-    def prepare_data(self):
-        """Create the dataset"""
+    def shuffled_cat(self, *xs: torch.Tensor) -> torch.Tensor:
+        """
+        Concatenate the given points in a random order. Each point is written directly
+        to its shuffled position, so this takes a single copy of the points (rather
+        than one copy to concatenate them and another to shuffle them).
+
+        args:
+            xs: the tensors of points to concatenate
+        returns:
+            the concatenated points, in a random order
+        """
+        n_points = sum(x.shape[0] for x in xs)
+        shuffled = torch.empty(n_points, *xs[0].shape[1:]).type_as(xs[0])
+
+        random_indices = torch.randperm(n_points, device=shuffled.device)
+        start = 0
+        for x in xs:
+            shuffled[random_indices[start : start + x.shape[0]]] = x
+            start += x.shape[0]
+
+        return shuffled
+
+    def compute_mask(
+        self, mask_fn: Callable[[torch.Tensor], torch.Tensor], x: torch.Tensor
+    ) -> torch.Tensor:
+        """
+        Evaluate a mask function on the given points in chunks, writing the results
+        into a single preallocated tensor. This bounds the size of the intermediate
+        tensors created by the mask function, no matter how many points there are.
+
+        args:
+            mask_fn: a function returning a boolean mask for a batch of points
+            x: the points to evaluate
+        returns:
+            the boolean mask of x
+        """
+        mask = torch.empty(x.shape[0], dtype=torch.bool, device=x.device)
+        for start in range(0, x.shape[0], self.MASK_CHUNK_SIZE):
+            end = start + self.MASK_CHUNK_SIZE
+            mask[start:end] = mask_fn(x[start:end])
+
+        return mask
+
+    def compute_labels(
+        self, x: torch.Tensor
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """
+        Compute the goal, safe, and unsafe masks of the given points
+
+        args:
+            x: the points to label
+        returns:
+            a tuple of boolean tensors (goal_mask, safe_mask, unsafe_mask)
+        """
+        return (
+            self.compute_mask(self.model.goal_mask, x),
+            self.compute_mask(self.model.safe_mask, x),
+            self.compute_mask(self.model.unsafe_mask, x),
+        )
+
+    @property
+    def cache_path(self) -> Optional[str]:
+        """
+        The file used to cache the initial dataset, or None if caching is disabled.
+        The file name hashes everything that prepare_data depends on (except for the
+        code of the dynamics model itself), including the random seed.
+        """
+        if self.cache_dir is None:
+            return None
+
+        settings: List = [
+            type(self.model).__name__,
+            sorted(self.model.nominal_params.items()),
+            self.model.dt,
+            self.model.controller_dt,
+            self.initial_domain,
+            self.trajectories_per_episode,
+            self.trajectory_length,
+            self.fixed_samples,
+            self.val_split,
+            sorted(self.quotas.items()),
+            torch.initial_seed(),
+        ]
+
+        # The simulated trajectories depend on the nominal controller, which is set
+        # by the scenarios used to linearize the model
+        if hasattr(self.model, "K"):
+            settings.append(self.model.K.tolist())
+
+        # The masks of lidar-based systems depend on the scene and the sensor
+        if isinstance(self.model, PlanarLidarSystem):
+            settings += [
+                [obstacle.wkt for obstacle in self.model.scene.obstacles],
+                self.model.num_rays,
+                self.model.field_of_view,
+                self.model.max_distance,
+                self.model.noise,
+            ]
+
+        settings_hash = hashlib.sha256(repr(settings).encode()).hexdigest()[:16]
+        filename = f"{type(self.model).__name__}_{settings_hash}.pt"
+
+        return os.path.join(self.cache_dir, filename)
+
+    def generate_data(self) -> Dict[str, torch.Tensor]:
+        """
+        Simulate and sample the initial dataset, split it into training and
+        validation sets, and label it.
+
+        returns:
+            a dictionary containing the training and validation points ("x_training",
+            "x_validation") and their goal, safe, unsafe, and boundary masks (e.g.
+            "goal_training", "safe_validation")
+        """
         # Get some data points from simulations
         x_sim = self.sample_trajectories(self.model.nominal_simulator)
 
-        # Augment those points with samples from the fixed range
+        # Augment those points with samples from the fixed range, shuffling them as
+        # they are combined
         x_sample = self.sample_fixed()
-        x = torch.cat((x_sim, x_sample), dim=0)
+        x = self.shuffled_cat(x_sim, x_sample)
 
-        # Randomly split data into training and test sets
-        random_indices = torch.randperm(x.shape[0])
+        # Randomly split data into training and test sets, as views of the shuffled
+        # points (rather than gathering each set into its own copy)
         val_pts = int(x.shape[0] * self.val_split)
-        validation_indices = random_indices[:val_pts]
-        training_indices = random_indices[val_pts:]
-        self.x_training = x[training_indices]
-        self.x_validation = x[validation_indices]
+        data = {"x_validation": x[:val_pts], "x_training": x[val_pts:]}
+
+        # Label the points (only once, since these are reused for the datasets)
+        for split in ["training", "validation"]:
+            x_split = data[f"x_{split}"]
+            goal, safe, unsafe = self.compute_labels(x_split)
+            data[f"goal_{split}"] = goal
+            data[f"safe_{split}"] = safe
+            data[f"unsafe_{split}"] = unsafe
+            data[f"boundary_{split}"] = self.compute_mask(
+                self.model.boundary_mask, x_split
+            )
+
+        return data
+
+    def prepare_data(self):
+        """Create the dataset"""
+        # Load the data from the cache if we've generated it before, and generate it
+        # (saving it to the cache if one is used) otherwise. Generating the data
+        # advances the random number generator, so the cache also saves its state
+        # after generation and restores it when loading; that way everything sampled
+        # afterwards is the same whether or not the data came from the cache.
+        cache_path = self.cache_path
+        if cache_path is not None and os.path.exists(cache_path):
+            print(f"Loading cached dataset from {cache_path}")
+            data = torch.load(cache_path)
+            torch.set_rng_state(data["rng_state"])
+        else:
+            data = self.generate_data()
+            if cache_path is not None:
+                data["rng_state"] = torch.get_rng_state()
+                os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+                torch.save(data, cache_path)
+
+        self.x_training = data["x_training"]
+        self.x_validation = data["x_validation"]
 
         print("Full dataset:")
         print(f"\t{self.x_training.shape[0]} training")
         print(f"\t{self.x_validation.shape[0]} validation")
         print("\t----------------------")
-        print(f"\t{self.model.goal_mask(self.x_training).sum()} goal points")
-        print(f"\t({self.model.goal_mask(self.x_validation).sum()} val)")
-        print(f"\t{self.model.safe_mask(self.x_training).sum()} safe points")
-        print(f"\t({self.model.safe_mask(self.x_validation).sum()} val)")
-        print(f"\t{self.model.unsafe_mask(self.x_training).sum()} unsafe points")
-        print(f"\t({self.model.unsafe_mask(self.x_validation).sum()} val)")
-        print(f"\t{self.model.boundary_mask(self.x_training).sum()} boundary points")
-        print(f"\t({self.model.boundary_mask(self.x_validation).sum()} val)")
+        print(f"\t{data['goal_training'].sum()} goal points")
+        print(f"\t({data['goal_validation'].sum()} val)")
+        print(f"\t{data['safe_training'].sum()} safe points")
+        print(f"\t({data['safe_validation'].sum()} val)")
+        print(f"\t{data['unsafe_training'].sum()} unsafe points")
+        print(f"\t({data['unsafe_validation'].sum()} val)")
+        print(f"\t{data['boundary_training'].sum()} boundary points")
+        print(f"\t({data['boundary_validation'].sum()} val)")
 
         # Turn these into tensor datasets
         self.training_data = TensorDataset(
             self.x_training,
-            self.model.goal_mask(self.x_training),
-            self.model.safe_mask(self.x_training),
-            self.model.unsafe_mask(self.x_training),
+            data["goal_training"],
+            data["safe_training"],
+            data["unsafe_training"],
         )
         self.validation_data = TensorDataset(
             self.x_validation,
-            self.model.goal_mask(self.x_validation),
-            self.model.safe_mask(self.x_validation),
-            self.model.unsafe_mask(self.x_validation),
+            data["goal_validation"],
+            data["safe_validation"],
+            data["unsafe_validation"],
         )
 
     def add_data(self, simulator: Callable[[torch.Tensor, int], torch.Tensor]):
@@ -184,24 +359,26 @@ class EpisodicDataModule(pl.LightningDataModule):
         # Get some data points from simulations
         x_sim = self.sample_trajectories(simulator)
 
-        # # Augment those points with samples from the fixed range
+        # # Augment those points with samples from the fixed range, shuffling them as
+        # they are combined
         x_sample = self.sample_fixed()
-        x = torch.cat((x_sim.type_as(x_sample), x_sample), dim=0)
-        x = x.type_as(self.x_training)
+        x = self.shuffled_cat(
+            x_sim.type_as(self.x_training), x_sample.type_as(self.x_training)
+        )
 
         print(f"Sampled {x.shape[0]} new points")
 
-        # Randomly split data into training and test sets
-        random_indices = torch.randperm(x.shape[0])
+        # Randomly split data into training and test sets, as views of the shuffled
+        # points (which are only copied again when appended below)
         val_pts = int(x.shape[0] * self.val_split)
-        validation_indices = random_indices[:val_pts]
-        training_indices = random_indices[val_pts:]
+        x_validation = x[:val_pts]
+        x_training = x[val_pts:]
 
-        print(f"\t{training_indices.shape[0]} train, {validation_indices.shape[0]} val")
+        print(f"\t{x_training.shape[0]} train, {x_validation.shape[0]} val")
 
         # Augment the existing data with the new points
-        self.x_training = torch.cat((self.x_training, x[training_indices]))
-        self.x_validation = torch.cat((self.x_validation, x[validation_indices]))
+        self.x_training = torch.cat((self.x_training, x_training))
+        self.x_validation = torch.cat((self.x_validation, x_validation))
 
         # If we've exceeded the maximum number of points, forget the oldest
         if self.x_training.shape[0] + self.x_validation.shape[0] > self.max_points:
@@ -213,29 +390,27 @@ class EpisodicDataModule(pl.LightningDataModule):
             self.x_training = self.x_training[-n_train:]
             self.x_validation = self.x_validation[-n_val:]
 
+        # Label the points (only once, since these are reused for the datasets)
+        goal_train, safe_train, unsafe_train = self.compute_labels(self.x_training)
+        goal_val, safe_val, unsafe_val = self.compute_labels(self.x_validation)
+
         print("Full dataset:")
         print(f"\t{self.x_training.shape[0]} training")
         print(f"\t{self.x_validation.shape[0]} validation")
         print("\t----------------------")
-        print(f"\t{self.model.goal_mask(self.x_training).sum()} goal points")
-        print(f"\t({self.model.goal_mask(self.x_validation).sum()} val)")
-        print(f"\t{self.model.safe_mask(self.x_training).sum()} safe points")
-        print(f"\t({self.model.safe_mask(self.x_validation).sum()} val)")
-        print(f"\t{self.model.unsafe_mask(self.x_training).sum()} unsafe points")
-        print(f"\t({self.model.unsafe_mask(self.x_validation).sum()} val)")
+        print(f"\t{goal_train.sum()} goal points")
+        print(f"\t({goal_val.sum()} val)")
+        print(f"\t{safe_train.sum()} safe points")
+        print(f"\t({safe_val.sum()} val)")
+        print(f"\t{unsafe_train.sum()} unsafe points")
+        print(f"\t({unsafe_val.sum()} val)")
 
         # Save the new datasets
         self.training_data = TensorDataset(
-            self.x_training,
-            self.model.goal_mask(self.x_training),
-            self.model.safe_mask(self.x_training),
-            self.model.unsafe_mask(self.x_training),
+            self.x_training, goal_train, safe_train, unsafe_train
         )
         self.validation_data = TensorDataset(
-            self.x_validation,
-            self.model.goal_mask(self.x_validation),
-            self.model.safe_mask(self.x_validation),
-            self.model.unsafe_mask(self.x_validation),
+            self.x_validation, goal_val, safe_val, unsafe_val
         )
 
     def setup(self, stage=None):
@@ -244,10 +419,14 @@ class EpisodicDataModule(pl.LightningDataModule):
 
     def train_dataloader(self):
         """Make the DataLoader for training data"""
+        # Pin the batches when training on a GPU so that host-to-device copies can
+        # happen asynchronously
         return DataLoader(
             self.training_data,
             batch_size=self.batch_size,
+            shuffle=True,
             num_workers=4,
+            pin_memory=torch.cuda.is_available(),
         )
 
     def val_dataloader(self):
@@ -256,4 +435,5 @@ class EpisodicDataModule(pl.LightningDataModule):
             self.validation_data,
             batch_size=self.batch_size,
             num_workers=4,
+            pin_memory=torch.cuda.is_available(),
         )
@@ -1,10 +1,15 @@
 """Test the data generation for the f16 gcas"""
+import os
 import random
 from typing import Dict
 
+import numpy as np
+from shapely.geometry import box
 import torch
 
 from neural_clbf.datamodules.episodic_datamodule import EpisodicDataModule
+from neural_clbf.systems import TurtleBot2D
+from neural_clbf.systems.planar_lidar_system import Scene
 from neural_clbf.systems.tests.mock_system import MockSystem
 
 
@@ -109,3 +114,125 @@ def test_episodic_datamodule_quotas():
     assert len(train_dl) == round(train_pts / dm.batch_size)
     val_dl = dm.val_dataloader()
     assert len(val_dl) == round(val_pts / dm.batch_size)
+
+
+def test_episodic_datamodule_chunked_masks():
+    """Test that labeling points in chunks matches labeling them all at once"""
+    # Set a random seed for repeatability
+    random.seed(0)
+    torch.manual_seed(0)
+
+    initial_domain = [
+        (-1.0, 1.0),
+        (-1.0, 1.0),
+    ]
+    dm = EpisodicDataModule(model, initial_domain)
+    # Use a small chunk size so that the points get split into several (uneven)
+    # chunks
+    dm.MASK_CHUNK_SIZE = 128
+
+    x = model.sample_state_space(1000)
+    goal_mask, safe_mask, unsafe_mask = dm.compute_labels(x)
+    assert torch.equal(goal_mask, model.goal_mask(x))
+    assert torch.equal(safe_mask, model.safe_mask(x))
+    assert torch.equal(unsafe_mask, model.unsafe_mask(x))
+
+
+def test_episodic_datamodule_shuffled_cat():
+    """Test that shuffling points while concatenating them keeps every point"""
+    # Set a random seed for repeatability
+    random.seed(0)
+    torch.manual_seed(0)
+
+    initial_domain = [
+        (-1.0, 1.0),
+        (-1.0, 1.0),
+    ]
+    dm = EpisodicDataModule(model, initial_domain)
+
+    # Use points that are easy to tell apart
+    x1 = torch.arange(0.0, 20.0).reshape(-1, 2)
+    x2 = torch.arange(20.0, 50.0).reshape(-1, 2)
+    x = dm.shuffled_cat(x1, x2)
+
+    # The result should be a reordering of the concatenated points
+    x_expected = torch.cat((x1, x2))
+    assert x.shape == x_expected.shape
+    assert not torch.equal(x, x_expected)
+    sort_order = x[:, 0].argsort()
+    assert torch.equal(x[sort_order], x_expected)
+
+
+def test_episodic_datamodule_cache(tmp_path):
+    """Test that the EpisodicDataModule can reload its initial data from a cache"""
+    # Set a random seed for repeatability
+    random.seed(0)
+    torch.manual_seed(0)
+
+    initial_domain = [
+        (-1.0, 1.0),
+        (-1.0, 1.0),
+    ]
+    dm = EpisodicDataModule(
+        model,
+        initial_domain,
+        trajectories_per_episode=10,
+        trajectory_length=50,
+        fixed_samples=100,
+        cache_dir=str(tmp_path),
+    )
+
+    # The first call should generate the data and save it to the cache
+    dm.prepare_data()
+    assert os.path.exists(dm.cache_path)
+    x_after_generating = torch.rand(10)
+
+    # and a second data module with the same settings should load the same data
+    dm_cached = EpisodicDataModule(
+        model,
+        initial_domain,
+        trajectories_per_episode=10,
+        trajectory_length=50,
+        fixed_samples=100,
+        cache_dir=str(tmp_path),
+    )
+    assert dm_cached.cache_path == dm.cache_path
+    torch.manual_seed(0)
+    dm_cached.prepare_data()
+    x_after_loading = torch.rand(10)
+    assert torch.equal(dm_cached.x_training, dm.x_training)
+    assert torch.equal(dm_cached.x_validation, dm.x_validation)
+    for cached_tensor, tensor in zip(
+        dm_cached.training_data.tensors, dm.training_data.tensors
+    ):
+        assert torch.equal(cached_tensor, tensor)
+
+    # Anything sampled afterwards should also be the same as if we hadn't used the
+    # cache
+    assert torch.equal(x_after_loading, x_after_generating)
+
+    # Changing the settings should change the cache file
+    dm_cached.fixed_samples = 200
+    assert dm_cached.cache_path != dm.cache_path
+
+
+def test_episodic_datamodule_cache_path_depends_on_scene(tmp_path):
+    """Test that the cache for a lidar-based system depends on the scene"""
+
+    def make_datamodule(obstacle_size: float, num_rays: int = 10):
+        scene = Scene([])
+        scene.add_walls(10.0)
+        scene.add_obstacle(box(0.0, 0.0, obstacle_size, obstacle_size))
+        turtlebot = TurtleBot2D({"R": 3.25, "L": 14.0}, scene, num_rays=num_rays)
+        initial_domain = [
+            (-4.0, 4.0),
+            (-4.0, 4.0),
+            (-np.pi, np.pi),
+        ]
+        return EpisodicDataModule(turtlebot, initial_domain, cache_dir=str(tmp_path))
+
+    # The same scene and sensor should use the same cache
+    assert make_datamodule(1.0).cache_path == make_datamodule(1.0).cache_path
+    # but changing either should not
+    assert make_datamodule(1.0).cache_path != make_datamodule(2.0).cache_path
+    assert make_datamodule(1.0).cache_path != make_datamodule(1.0, 20).cache_path
@@ -302,8 +302,7 @@ class ControlAffineSystem(ABC):
 
         # Sample uniformly from 0 to 1 and then shift and scale to match state limits
         x = torch.Tensor(num_samples, self.n_dims).uniform_(0.0, 1.0)
-        for i in range(self.n_dims):
-            x[:, i] = x[:, i] * (x_max[i] - x_min[i]) + x_min[i]
+        x.mul_((x_max - x_min).type_as(x)).add_(x_min.type_as(x))
 
         return x
 
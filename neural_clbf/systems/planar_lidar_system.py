@@ -181,14 +181,23 @@ class Scene:
         if qs.ndim == 1:
             qs = torch.reshape(qs, (1, -1))
 
-        # Create the array to store the results, then iterate through each sample point
-        measurements = torch.zeros(qs.shape[0], 2, num_rays).type_as(qs)
+        # Create the array to store the contact points, then iterate through each
+        # sample point
+        contact_pts_world = np.zeros((qs.shape[0], 2, num_rays))
 
         # Figure out the angles to measure on
         angles = torch.linspace(field_of_view[0], field_of_view[1], num_rays)
 
-        for q_idx, q in enumerate(qs):
-            agent_point = Point(q[0].item(), q[1].item())
+        # Compute the direction of every ray for every sample point at once, rather
+        # than converting each heading to a scalar inside the loop
+        qs_np = qs.detach().cpu().numpy()
+        ray_angles = qs[:, 2:3].detach().cpu().type_as(angles) + angles
+        ray_directions = torch.stack(
+            (torch.cos(ray_angles), torch.sin(ray_angles)), dim=-1
+        ).numpy()
+
+        for q_idx, q in enumerate(qs_np):
+            agent_point = Point(q[0], q[1])
 
             # Check if we're in collision
             in_collision = False
@@ -198,13 +207,8 @@ class Scene:
             # Sweep through the field of view, checking for an intersection
             # out to max_distance
             for ray_idx in range(num_rays):
-                ray_start = q[:2].detach().numpy()  # start at the agent (x, y)
-                ray_direction = np.array(
-                    [
-                        np.cos(q[2].detach().item() + angles[ray_idx]),
-                        np.sin(q[2].detach().item() + angles[ray_idx]),
-                    ]
-                )
+                ray_start = q[:2]  # start at the agent (x, y)
+                ray_direction = ray_directions[q_idx, ray_idx]
                 ray_end = ray_start + max_distance * ray_direction
                 ray = LineString([ray_start, ray_end])
 
@@ -250,20 +254,18 @@ class Scene:
                     contact_x += np.random.normal(0.0, noise)
                     contact_y += np.random.normal(0.0, noise)
 
-                # Get the point relative to the agent coordinates in the world frame
-                contact_pt_world = torch.tensor([contact_x, contact_y]).type_as(q)
-                contact_offset_world = contact_pt_world - q[:2]
-                # Rotate the point by -theta to bring it into the agent frame
-                rotation_mat = torch.tensor(
-                    [
-                        [torch.cos(q[2]), torch.sin(q[2])],
-                        [-torch.sin(q[2]), torch.cos(q[2])],
-                    ]
-                )
-                contact_pt_agent = torch.matmul(rotation_mat, contact_offset_world)
-
-                # Save the measurement
-                measurements[q_idx, :2, ray_idx] = contact_pt_agent
+                # Save the contact point
+                contact_pts_world[q_idx, :, ray_idx] = (contact_x, contact_y)
+
+        # Get the points relative to the agent coordinates in the world frame
+        contact_pts_world_t = torch.tensor(contact_pts_world).type_as(qs)
+        contact_offsets_world = contact_pts_world_t - qs[:, :2].unsqueeze(-1)
+
+        # Rotate the points by -theta to bring them into the agent frame, using the
+        # rotation matrices for the whole batch at once
+        c, s = torch.cos(qs[:, 2]), torch.sin(qs[:, 2])
+        rotation_mats = torch.stack((c, s, -s, c), dim=-1).reshape(-1, 2, 2)
+        measurements = torch.bmm(rotation_mats, contact_offsets_world)
 
         return measurements
 
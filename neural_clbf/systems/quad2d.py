@@ -5,7 +5,7 @@ import torch
 import numpy as np
 
 from .control_affine_system import ControlAffineSystem
-from .utils import grav, Scenario
+from .utils import grav, Scenario, compile_if_available
 
 
 class Quad2D(ControlAffineSystem):
@@ -134,34 +134,7 @@ class Quad2D(ControlAffineSystem):
         args:
             x: a tensor of points in the state space
         """
-        safe_mask = torch.ones_like(x[:, 0], dtype=torch.bool)
-
-        # We have a floor that we need to avoid
-        safe_z = -0.1
-        floor_mask = x[:, 1] >= safe_z
-        safe_mask.logical_and_(floor_mask)
-
-        # We also have a block obstacle to the left at ground level
-        obs1_min_x, obs1_max_x = (-1.1, -0.4)
-        obs1_min_z, obs1_max_z = (-0.5, 0.6)
-        obs1_mask_x = torch.logical_or(x[:, 0] <= obs1_min_x, x[:, 0] >= obs1_max_x)
-        obs1_mask_z = torch.logical_or(x[:, 1] <= obs1_min_z, x[:, 1] >= obs1_max_z)
-        obs1_mask = torch.logical_or(obs1_mask_x, obs1_mask_z)
-        safe_mask.logical_and_(obs1_mask)
-
-        # We also have a block obstacle to the right in the air
-        obs2_min_x, obs2_max_x = (-0.1, 1.1)
-        obs2_min_z, obs2_max_z = (0.7, 1.5)
-        obs2_mask_x = torch.logical_or(x[:, 0] <= obs2_min_x, x[:, 0] >= obs2_max_x)
-        obs2_mask_z = torch.logical_or(x[:, 1] <= obs2_min_z, x[:, 1] >= obs2_max_z)
-        obs2_mask = torch.logical_or(obs2_mask_x, obs2_mask_z)
-        safe_mask.logical_and_(obs2_mask)
-
-        # Also constrain to be within a norm bound
-        norm_mask = x.norm(dim=-1) <= 4.5
-        safe_mask.logical_and_(norm_mask)
-
-        return safe_mask
+        return _obstacle_safe_mask(x)
 
     def unsafe_mask(self, x):
         """Return the mask of x indicating unsafe regions for the obstacle task
@@ -169,34 +142,7 @@ class Quad2D(ControlAffineSystem):
         args:
             x: a tensor of points in the state space
         """
-        unsafe_mask = torch.zeros_like(x[:, 0], dtype=torch.bool)
-
-        # We have a floor that we need to avoid
-        unsafe_z = -0.3
-        floor_mask = x[:, 1] <= unsafe_z
-        unsafe_mask.logical_or_(floor_mask)
-
-        # We also have a block obstacle to the left at ground level
-        obs1_min_x, obs1_max_x = (-1.0, -0.5)
-        obs1_min_z, obs1_max_z = (-0.4, 0.5)
-        obs1_mask_x = torch.logical_and(x[:, 0] >= obs1_min_x, x[:, 0] <= obs1_max_x)
-        obs1_mask_z = torch.logical_and(x[:, 1] >= obs1_min_z, x[:, 1] <= obs1_max_z)
-        obs1_mask = torch.logical_and(obs1_mask_x, obs1_mask_z)
-        unsafe_mask.logical_or_(obs1_mask)
-
-        # We also have a block obstacle to the right in the air
-        obs2_min_x, obs2_max_x = (0.0, 1.0)
-        obs2_min_z, obs2_max_z = (0.8, 1.4)
-        obs2_mask_x = torch.logical_and(x[:, 0] >= obs2_min_x, x[:, 0] <= obs2_max_x)
-        obs2_mask_z = torch.logical_and(x[:, 1] >= obs2_min_z, x[:, 1] <= obs2_max_z)
-        obs2_mask = torch.logical_and(obs2_mask_x, obs2_mask_z)
-        unsafe_mask.logical_or_(obs2_mask)
-
-        # Also constrain with a norm bound
-        norm_mask = x.norm(dim=-1) >= 7.0
-        unsafe_mask.logical_or_(norm_mask)
-
-        return unsafe_mask
+        return _obstacle_unsafe_mask(x)
 
     def goal_mask(self, x):
         """Return the mask of x indicating points in the goal set (within 0.2 m of the
@@ -299,3 +245,81 @@ class Quad2D(ControlAffineSystem):
             + self.nominal_params["m"] * grav / 2.0
         )
         return u_eq
+
+
+@compile_if_available
+def _obstacle_safe_mask(x: torch.Tensor) -> torch.Tensor:
+    """Return the mask of x indicating safe regions for the Quad2D obstacle task
+
+    args:
+        x: a tensor of points in the state space
+    """
+    px, pz = x[:, Quad2D.PX], x[:, Quad2D.PZ]
+
+    # We have a floor that we need to avoid
+    safe_z = -0.1
+    floor_mask = pz >= safe_z
+
+    # We also have a block obstacle to the left at ground level
+    obs1_min_x, obs1_max_x = (-1.1, -0.4)
+    obs1_min_z, obs1_max_z = (-0.5, 0.6)
+    obs1_mask = (
+        (px <= obs1_min_x)
+        | (px >= obs1_max_x)
+        | (pz <= obs1_min_z)
+        | (pz >= obs1_max_z)
+    )
+
+    # We also have a block obstacle to the right in the air
+    obs2_min_x, obs2_max_x = (-0.1, 1.1)
+    obs2_min_z, obs2_max_z = (0.7, 1.5)
+    obs2_mask = (
+        (px <= obs2_min_x)
+        | (px >= obs2_max_x)
+        | (pz <= obs2_min_z)
+        | (pz >= obs2_max_z)
+    )
+
+    # Also constrain to be within a norm bound
+    norm_mask = x.norm(dim=-1) <= 4.5
+
+    return floor_mask & obs1_mask & obs2_mask & norm_mask
+
+
+@compile_if_available
+def _obstacle_unsafe_mask(x: torch.Tensor) -> torch.Tensor:
+    """Return the mask of x indicating unsafe regions for the Quad2D obstacle task
+
+    args:
+        x: a tensor of points in the state space
+    """
+    px, pz = x[:, Quad2D.PX], x[:, Quad2D.PZ]
+
+    # We have a floor that we need to avoid
+    unsafe_z = -0.3
+    floor_mask = pz <= unsafe_z
+
+    # We also have a block obstacle to the left at ground level
+    obs1_min_x, obs1_max_x = (-1.0, -0.5)
+    obs1_min_z, obs1_max_z = (-0.4, 0.5)
+    obs1_mask = (
+        (px >= obs1_min_x)
+        & (px <= obs1_max_x)
+        & (pz >= obs1_min_z)
+        & (pz <= obs1_max_z)
+    )
+
+    # We also have a block obstacle to the right in the air
+    obs2_min_x, obs2_max_x = (0.0, 1.0)
+    obs2_min_z, obs2_max_z = (0.8, 1.4)
+    obs2_mask = (
+        (px >= obs2_min_x)
+        & (px <= obs2_max_x)
+        & (pz >= obs2_min_z)
+        & (pz <= obs2_max_z)
+    )
+
+    # Also constrain with a norm bound
+    norm_mask = x.norm(dim=-1) >= 7.0
+
+    return floor_mask | obs1_mask | obs2_mask | norm_mask
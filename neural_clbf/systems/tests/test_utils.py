@@ -0,0 +1,52 @@
+"""Test the helper functions for dynamical systems"""
+import pytest
+import torch
+
+from neural_clbf.systems.utils import compile_if_available
+
+
+def double(x: torch.Tensor) -> torch.Tensor:
+    return 2 * x
+
+
+def test_compile_if_available_falls_back_when_compiling_fails(monkeypatch):
+    """Test that functions still run uncompiled if torch.compile fails"""
+    x = torch.arange(4.0)
+
+    # Make compilation fail when the compiled function is first called
+    def compile_that_fails_on_call(fn, **kwargs):
+        def compiled_fn(*args, **kwargs):
+            raise RuntimeError("no compiler")
+
+        return compiled_fn
+
+    monkeypatch.setattr(torch, "compile", compile_that_fails_on_call, raising=False)
+    double_compiled = compile_if_available(double)
+    with pytest.warns(UserWarning, match="no compiler"):
+        assert torch.equal(double_compiled(x), 2 * x)
+    # After the first failure, it should keep running uncompiled
+    assert torch.equal(double_compiled(x), 2 * x)
+
+    # Also make compilation fail right away
+    def compile_that_fails(fn, **kwargs):
+        raise RuntimeError("unsupported Python version")
+
+    monkeypatch.setattr(torch, "compile", compile_that_fails, raising=False)
+    with pytest.warns(UserWarning, match="unsupported Python version"):
+        double_compiled = compile_if_available(double)
+    assert torch.equal(double_compiled(x), 2 * x)
+
+
+def test_compile_if_available_raises_input_errors(monkeypatch):
+    """Test that errors from bad inputs are raised, not hidden by the fallback"""
+
+    def compile_that_fails_on_call(fn, **kwargs):
+        def compiled_fn(*args, **kwargs):
+            raise RuntimeError("no compiler")
+
+        return compiled_fn
+
+    monkeypatch.setattr(torch, "compile", compile_that_fails_on_call, raising=False)
+    double_compiled = compile_if_available(double)
+    with pytest.raises(TypeError):
+        double_compiled(None)
@@ -1,9 +1,12 @@
 """Defines useful constants and helper functions for dynamical systems"""
-from typing import Dict, List
+import functools
+from typing import Callable, Dict, List
+from warnings import warn
 
 import numpy as np
 import scipy.linalg
 import cvxpy as cp
+import torch
 
 
 # Gravitation acceleration
@@ -14,6 +17,44 @@ Scenario = Dict[str, float]
 ScenarioList = List[Scenario]
 
 
+def compile_if_available(fn: Callable) -> Callable:
+    """Compile fn with torch.compile, which can fuse elementwise kernels into a single
+    pass over the input. torch.compile is only available in PyTorch >= 2.0, so fall
+    back to the uncompiled function on older versions. Compiling can also fail when
+    the function is first called (e.g. if there is no C++ compiler for the generated
+    kernels, or the Python version is not supported), in which case this warns and
+    falls back to the uncompiled function from then on.
+    """
+    if not hasattr(torch, "compile"):
+        return fn
+
+    try:
+        compiled_fn = torch.compile(fn, dynamic=True)  # type: ignore
+    except Exception as e:
+        warn(f"Could not compile {fn.__name__}, so running it uncompiled: {e}")
+        return fn
+
+    use_compiled = True
+
+    @functools.wraps(fn)
+    def fn_with_fallback(*args, **kwargs):
+        nonlocal use_compiled
+        if not use_compiled:
+            return fn(*args, **kwargs)
+
+        try:
+            return compiled_fn(*args, **kwargs)
+        except Exception as e:
+            # If the uncompiled function fails too, then the problem is with the
+            # inputs, so let that error through without giving up on compiling
+            result = fn(*args, **kwargs)
+            warn(f"Could not compile {fn.__name__}, so running it uncompiled: {e}")
+            use_compiled = False
+            return result
+
+    return fn_with_fallback
+
+
 def lqr(
     A: np.ndarray,
     B: np.ndarray,